@@ -3,9 +3,9 @@ from typing import Callable, List
 
 import cv2
 import pandas as pd
-from PIL import Image
 import torch
 from torch.utils.data import Dataset
+from torchvision.transforms.functional import to_pil_image
 
 from .transforms import tensor_transform
 from .utils import ON_KAGGLE
@@ -59,16 +59,18 @@ class TTADataset:
 def load_transform_image(
         item, root: Path, image_transform: Callable, debug: bool = False):
     image = load_image(item, root)
-    image = image_transform(image)
+    image = tensor_transform(image_transform(image))
     if debug:
-        image.save('_debug.png')
-    return tensor_transform(image)
+        to_pil_image(image).save('_debug.png')
+    return image
 
 
-def load_image(item, root: Path) -> Image.Image:
+def load_image(item, root: Path) -> torch.Tensor:
+    """ Return the image as a uint8 CHW tensor.
+    """
     image = cv2.imread(str(root / f'{item.id}.png'))
     image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-    return Image.fromarray(image)
+    return torch.from_numpy(image).permute(2, 0, 1)
 
 
 def get_ids(root: Path) -> List[str]:
@@ -1,16 +1,18 @@
 import argparse
+from collections import deque
 from itertools import islice
 import json
 import os
 from pathlib import Path
 import shutil
-import warnings
-from typing import Callable, Dict
+from typing import Callable, Dict, List
 
 import numpy as np
 import pandas as pd
-from sklearn.metrics import fbeta_score
-from sklearn.exceptions import UndefinedMetricWarning
+try:
+    import numba
+except ImportError:  # not always available on Kaggle
+    numba = None
 import torch
 from torch import nn, cuda
 from torch.optim import Adam, SGD, lr_scheduler
@@ -18,10 +20,10 @@ import tqdm
 
 from . import models
 from .dataset import TrainDataset, TTADataset, get_ids, N_CLASSES, DATA_ROOT
-from .transforms import get_transforms
+from .transforms import get_transforms, BatchNormalize
 from .utils import (
-    write_event, load_model, mean_df, ThreadingDataLoader as DataLoader,
-    FocalLoss, ON_KAGGLE)
+    write_event, load_model, save_predictions,
+    ThreadingDataLoader as DataLoader, FocalLoss, ON_KAGGLE)
 
 
 def main():
@@ -72,6 +74,9 @@ def main():
             shuffle=True,
             batch_size=args.batch_size,
             num_workers=args.workers,
+            pin_memory=use_cuda,
+            persistent_workers=args.workers > 0,
+            prefetch_factor=4,
         )
     if args.loss == 'bce':
         criterion = nn.BCEWithLogitsLoss(reduction='none')
@@ -86,10 +91,9 @@ def main():
     model = getattr(models, args.model)(
         num_classes=N_CLASSES, pretrained=args.pretrained, dropout=args.dropout)
     use_cuda = cuda.is_available()
-    fresh_params = list(model.fresh_params())
-    all_params = list(model.parameters())
+    normalize = BatchNormalize(device='cuda' if use_cuda else 'cpu')
     if use_cuda:
-        model = model.cuda()
+        model = model.cuda().to(memory_format=torch.channels_last)
 
     if args.mode == 'train':
         if run_root.exists() and args.clean:
@@ -121,28 +125,33 @@ def main():
             patience=args.patience,
             init_optimizer=init_optimizer,
             use_cuda=use_cuda,
+            normalize=normalize,
         )
 
+        # train() materializes the parameters itself
         if args.pretrained and args.prev_model == 'none':
-            if train(params=fresh_params, n_epochs=1, **train_kwargs):
-                train(params=all_params, **train_kwargs)
+            if train(params=model.fresh_params(), n_epochs=1, **train_kwargs):
+                train(params=model.parameters(), **train_kwargs)
         else:
-            train(params=all_params, **train_kwargs)
+            train(params=model.parameters(), **train_kwargs)
 
     elif args.mode == 'validate':
         valid_loader = make_loader(valid_fold, test_transform)
         load_model(model, run_root / 'model.pt')
+        model = compile_for_inference(model, use_cuda)
         validation(args, model, criterion,
                    tqdm.tqdm(valid_loader, desc='Validation', disable = not args.verbose),
-                   use_cuda=use_cuda)
+                   use_cuda=use_cuda, normalize=normalize)
 
     elif args.mode.startswith('predict'):
         load_model(model, run_root / 'best-model.pt')
+        model = compile_for_inference(model, use_cuda)
         predict_kwargs = dict(
             batch_size=args.batch_size,
             tta=args.tta,
             transform=test_transform,
             use_cuda=use_cuda,
+            normalize=normalize,
             workers=args.workers,
         )
         if args.mode == 'predict_valid':
@@ -158,40 +167,63 @@ def main():
                     **predict_kwargs)
 
 
+def compile_for_inference(model: nn.Module, use_cuda: bool) -> nn.Module:
+    """ Compile the model for forward-only passes with torch.compile,
+    if it's available. Must be called after the weights are loaded.
+    The last (shorter) batch costs one extra compilation.
+    The Triton backend needs compute capability 7.0+ (e.g. not P100),
+    otherwise the model stays in eager mode.
+    """
+    if (use_cuda and hasattr(torch, 'compile') and
+            cuda.get_device_capability() >= (7, 0)):
+        model = torch.compile(model, mode='reduce-overhead')
+    return model
+
+
 def predict(args, model, root: Path, df: pd.DataFrame, out_path: Path,
             batch_size: int, tta: int, transform: Callable,
-            workers: int, use_cuda: bool):
+            workers: int, use_cuda: bool, normalize: Callable):
     loader = DataLoader(
         dataset=TTADataset(root, df, transform, tta=tta),
         shuffle=False,
         batch_size=batch_size,
         num_workers=workers,
+        pin_memory=use_cuda,
+        prefetch_factor=4,
     )
     model.eval()
-    all_outputs, all_ids = [], []
+    all_outputs = _empty_outputs(len(loader.dataset), use_cuda)
+    all_ids = []
     with torch.no_grad():
         for inputs, ids in tqdm.tqdm(loader, desc='Predict', disable = not args.verbose):
             if use_cuda:
-                inputs = inputs.cuda()
-            outputs = torch.sigmoid(model(inputs))
-            all_outputs.append(outputs.data.cpu().numpy())
+                inputs = inputs.cuda(non_blocking=True)
+                inputs = inputs.to(memory_format=torch.channels_last)
+            inputs = normalize(inputs)
+            with cuda.amp.autocast(enabled=use_cuda):
+                outputs = model(inputs)
+            outputs = torch.sigmoid(outputs.float())
+            # non-blocking copy into pinned memory, so that the next batch
+            # can be queued before this one is on the host
+            offset = len(all_ids)
+            all_outputs[offset: offset + len(ids)].copy_(
+                outputs, non_blocking=True)
             all_ids.extend(ids)
-    df = pd.DataFrame(
-        data=np.concatenate(all_outputs),
-        index=all_ids,
-        columns=map(str, range(N_CLASSES)))
-    df = mean_df(df)
-    df.to_hdf(out_path, 'prob', index_label='id')
+    if use_cuda:
+        torch.cuda.synchronize()
+    ids, probabilities = _mean_by_id(all_ids, all_outputs.numpy())
+    save_predictions(out_path, ids, probabilities)
     print(f'Saved predictions to {out_path}')
 
 
 def train(args, model: nn.Module, criterion, *, params,
-          train_loader, valid_loader, init_optimizer, use_cuda,
+          train_loader, valid_loader, init_optimizer, use_cuda, normalize,
           n_epochs=None, patience=2, max_lr_changes=2) -> bool:
     lr = args.lr
     n_epochs = n_epochs or args.n_epochs
     params = list(params)
     optimizer = init_optimizer(params, lr)
+    scaler = cuda.amp.GradScaler(enabled=use_cuda)
 
     run_root = Path(args.run_root)
     model_path = run_root / 'model.pt'
@@ -247,36 +279,51 @@ def train(args, model: nn.Module, criterion, *, params,
             total=(args.epoch_size or len(train_loader) * args.batch_size),
             disable = not args.verbose)
         tq.set_description(f'Epoch {epoch}, lr {lr:.3g}')
-        losses = []
-        tl = train_loader
+        losses = deque(maxlen=report_each)
+        losses_sum = 0
+        batches = iter(train_loader)
+        tl = batches
         if args.epoch_size:
             tl = islice(tl, args.epoch_size // args.batch_size)
         try:
             mean_loss = 0
             for i, (inputs, targets) in enumerate(tl):
                 if use_cuda:
-                    inputs, targets = inputs.cuda(), targets.cuda()
-                outputs = model(inputs)
-                loss = _reduce_loss(criterion(outputs, targets))
+                    inputs = inputs.cuda(non_blocking=True)
+                    inputs = inputs.to(memory_format=torch.channels_last)
+                    targets = targets.cuda(non_blocking=True)
+                inputs = normalize(inputs)
+                with cuda.amp.autocast(enabled=use_cuda):
+                    outputs = model(inputs)
+                # loss is computed in fp32 for numerical stability
+                loss = criterion(outputs.float(), targets).sum()
                 batch_size = inputs.size(0)
-                (batch_size * loss).backward()
+                # gradients are summed over samples, averaged over steps
+                scaler.scale(loss / args.step if args.step > 1 else loss).backward()
                 if (i + 1) % args.step == 0:
-                    optimizer.step()
-                    optimizer.zero_grad()
+                    scaler.step(optimizer)
+                    scaler.update()
+                    optimizer.zero_grad(set_to_none=True)
                     step += 1
                     if args.scheduler != 'none':
                         scheduler.step()
                         lr = optimizer.param_groups[0]['lr']
                 tq.update(batch_size)
-                losses.append(loss.item())
-                mean_loss = np.mean(losses[-report_each:])
+                if len(losses) == report_each:
+                    losses_sum -= losses[0]
+                losses.append(loss.item() / batch_size)
+                losses_sum += losses[-1]
+                mean_loss = losses_sum / len(losses)
                 tq.set_postfix(loss=f'{mean_loss:.3f}')
                 if i and i % report_each == 0:
                     write_event(log, epoch, step, lr, loss=mean_loss)
+            # drop batches queued past epoch_size before validation starts
+            batches.close()
             write_event(log, epoch, step, lr, loss=mean_loss)
             tq.close()
             save(epoch + 1)
-            valid_metrics = validation(args, model, criterion, valid_loader, use_cuda)
+            valid_metrics = validation(
+                args, model, criterion, valid_loader, use_cuda, normalize)
             write_event(log, epoch, step, lr, **valid_metrics)
             if args.metric == 'best_f2':
                 valid_loss = -valid_metrics['valid_max_f2']
@@ -307,40 +354,47 @@ def train(args, model: nn.Module, criterion, *, params,
 
 
 def validation(
-        args, model: nn.Module, criterion, valid_loader, use_cuda,
+        args, model: nn.Module, criterion, valid_loader, use_cuda, normalize,
         ) -> Dict[str, float]:
     model.eval()
-    all_losses, all_predictions, all_targets = [], [], []
+    all_losses = []
+    # valid_loader may be wrapped in tqdm, so size the buffers by batches
+    max_items = len(valid_loader) * args.batch_size
+    all_predictions = _empty_outputs(max_items, use_cuda)
+    all_targets = np.empty((max_items, N_CLASSES), dtype=np.uint8)
+    offset = 0
     with torch.no_grad():
         for inputs, targets in valid_loader:
-            all_targets.append(targets.numpy().copy())
+            all_targets[offset: offset + len(targets)] = targets.numpy()
             if use_cuda:
-                inputs, targets = inputs.cuda(), targets.cuda()
-            outputs = model(inputs)
+                inputs = inputs.cuda(non_blocking=True)
+                inputs = inputs.to(memory_format=torch.channels_last)
+                targets = targets.cuda(non_blocking=True)
+            inputs = normalize(inputs)
+            with cuda.amp.autocast(enabled=use_cuda):
+                outputs = model(inputs)
+            outputs = outputs.float()
             loss = criterion(outputs, targets)
             all_losses.append(_reduce_loss(loss).item())
             predictions = torch.sigmoid(outputs)
-            all_predictions.append(predictions.cpu().numpy())
-    all_predictions = np.concatenate(all_predictions)
-    all_targets = np.concatenate(all_targets)
-
-    def get_score(y_pred):
-        with warnings.catch_warnings():
-            warnings.simplefilter('ignore', category=UndefinedMetricWarning)
-            return fbeta_score(
-                all_targets, y_pred, beta=2, average='samples')
+            all_predictions[offset: offset + len(predictions)].copy_(
+                predictions, non_blocking=True)
+            offset += len(predictions)
+    if use_cuda:
+        torch.cuda.synchronize()
+    all_predictions = all_predictions[:offset].numpy()
+    all_targets = all_targets[:offset]
 
     metrics = {}
-    argsorted = all_predictions.argsort(axis=1)
     if args.loss == 'bce':
         threshs = [0.05, 0.06, 0.07, 0.08, 0.09, 0.10, 0.11, 0.12]
     elif args.loss == 'focal':
         threshs = [0.20, 0.22, 0.24, 0.26, 0.28, 0.30, 0.32, 0.34]
     else:
         threshs = [0.05, 0.10, 0.15, 0.20, 0.25, 0.30, 0.35, 0.40]
-    for threshold in threshs:
-        metrics[f'valid_f2_th_{threshold:.2f}'] = get_score(
-            binarize_prediction(all_predictions, threshold, argsorted))
+    scores = _f2_scores(all_predictions, all_targets, threshs)
+    for threshold, score in zip(threshs, scores):
+        metrics[f'valid_f2_th_{threshold:.2f}'] = score
     metrics['valid_max_f2'] = max(metrics.values())
     metrics['valid_loss'] = np.mean(all_losses)
     if args.verbose:
@@ -350,27 +404,103 @@ def validation(
     return metrics
 
 
-def binarize_prediction(probabilities, threshold: float, argsorted=None,
+def _f2_scores(probabilities, targets, thresholds,
+               min_labels=1, max_labels=10) -> List[float]:
+    """ Return sample-averaged F2 of binarize_prediction at each threshold.
+    Predictions for a sample are always its top n classes, with n between
+    min_labels and max_labels, so true positives are counted once along
+    the ranked top classes and only n depends on the threshold.
+    """
+    top = _top_k(probabilities, max_labels)
+    order = np.argsort(
+        -np.take_along_axis(probabilities, top, axis=1), axis=1)
+    top = np.take_along_axis(top, order, axis=1)
+    y_true = targets.astype(bool)
+    cum_tp = np.cumsum(np.take_along_axis(y_true, top, axis=1), axis=1)
+    n_true = y_true.sum(axis=1)
+    rows = np.arange(len(probabilities))
+    n_above = _count_above(probabilities, thresholds)
+    scores = []
+    for i in range(len(thresholds)):
+        n_pred = np.clip(n_above[:, i], min_labels, max_labels)
+        tp = cum_tp[rows, n_pred - 1]
+        # F2 = 5 tp / (5 tp + 4 fn + fp), zero when there are no tp
+        scores.append(float(np.mean(5 * tp / (4 * n_true + n_pred))))
+    return scores
+
+
+def _count_above(probabilities, thresholds):
+    """ Return (n_samples, n_thresholds) counts of probabilities above
+    each threshold, in a single pass over probabilities if numba is available.
+    Comparisons are done in float32 on both paths (fp16 would round the
+    thresholds), same as make_submission on loaded predictions.
+    """
+    probabilities = probabilities.astype(np.float32, copy=False)
+    thresholds = np.asarray(thresholds, dtype=np.float32)
+    if numba is not None:
+        return _count_above_njit(probabilities, thresholds)
+    return np.stack([(probabilities > threshold).sum(axis=1)
+                     for threshold in thresholds], axis=1)
+
+
+if numba is not None:
+    @numba.njit(parallel=True, cache=True)
+    def _count_above_njit(probabilities, thresholds):
+        n_rows, n_cols = probabilities.shape
+        counts = np.zeros((n_rows, len(thresholds)), dtype=np.int64)
+        for i in numba.prange(n_rows):
+            for j in range(n_cols):
+                for k in range(len(thresholds)):
+                    if probabilities[i, j] > thresholds[k]:
+                        counts[i, k] += 1
+        return counts
+
+
+def binarize_prediction(probabilities, threshold: float,
                         min_labels=1, max_labels=10):
     """ Return matrix of 0/1 predictions, same shape as probabilities.
     """
     assert probabilities.shape[1] == N_CLASSES
-    if argsorted is None:
-        argsorted = probabilities.argsort(axis=1)
-    max_mask = _make_mask(argsorted, max_labels)
-    min_mask = _make_mask(argsorted, min_labels)
+    max_mask = _make_mask(probabilities, _top_k(probabilities, max_labels))
+    min_mask = _make_mask(probabilities, _top_k(probabilities, min_labels))
     prob_mask = probabilities > threshold
     return (max_mask & prob_mask) | min_mask
 
 
-def _make_mask(argsorted, top_n: int):
-    mask = np.zeros_like(argsorted, dtype=np.uint8)
-    col_indices = argsorted[:, -top_n:].reshape(-1)
-    row_indices = [i // top_n for i in range(len(col_indices))]
-    mask[row_indices, col_indices] = 1
+def _top_k(probabilities, k: int):
+    """ Return (unordered) indices of the top k classes for each row.
+    """
+    if k == 1:
+        return probabilities.argmax(axis=1)[:, None]
+    return np.argpartition(probabilities, -k, axis=1)[:, -k:]
+
+
+def _make_mask(probabilities, indices):
+    mask = np.zeros(probabilities.shape, dtype=np.uint8)
+    np.put_along_axis(mask, indices, 1, axis=1)
     return mask
 
 
+def _mean_by_id(ids, outputs):
+    """ Average TTA outputs with the same id, return sorted unique ids
+    and their mean outputs.
+    """
+    unique_ids, inverse = np.unique(np.asarray(ids), return_inverse=True)
+    order = np.argsort(inverse, kind='stable')
+    counts = np.bincount(inverse)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    sums = np.add.reduceat(outputs[order], starts, axis=0, dtype=np.float32)
+    return unique_ids, sums / counts[:, None]
+
+
+def _empty_outputs(n_items: int, use_cuda: bool) -> torch.Tensor:
+    """ Preallocated fp16 host buffer for sigmoid outputs, pinned on CUDA
+    to allow non-blocking copies.
+    """
+    return torch.empty((n_items, N_CLASSES), dtype=torch.float16,
+                       pin_memory=use_cuda)
+
+
 def _reduce_loss(loss):
     return loss.sum() / loss.shape[0]
 
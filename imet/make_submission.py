@@ -2,7 +2,7 @@ import argparse
 
 import pandas as pd
 
-from .utils import mean_df
+from .utils import mean_df, load_predictions
 from .dataset import DATA_ROOT
 from .main import binarize_prediction
 
@@ -18,7 +18,7 @@ def main():
         DATA_ROOT / 'sample_submission.csv', index_col='id')
     dfs = []
     for prediction in args.predictions:
-        df = pd.read_hdf(prediction, index_col='id')
+        df = load_predictions(prediction)
         df = df.reindex(sample_submission.index)
         dfs.append(df)
     df = pd.concat(dfs)
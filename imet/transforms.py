@@ -1,109 +1,134 @@
 import random
 import math
 
-from PIL import Image, ImageOps
-from torchvision.transforms import (
-    ToTensor, Normalize, Compose, Resize, CenterCrop, RandomCrop,
+from PIL import Image
+import torch
+from torch import nn
+from torch.nn import functional as F
+from torchvision.transforms.v2 import (
+    ToImage, ToDtype, Compose, Resize, CenterCrop, RandomCrop,
     RandomHorizontalFlip, RandomResizedCrop, ColorJitter, Pad)
 
 
-class SquarePad(object):
-    def __init__(self):
-        pass
-
-    def __call__(self, img):
-        w, h = img.size
-        extra = int((w-h) % 2)
-
-        if w>h:
-            padding=(0, (w-h)//2 + extra, 0, (w-h)//2)
-        else:
-            padding=((h-w)//2 + extra, 0, (h-w)//2, 0)
-        return ImageOps.expand(img, padding)
+class SquarePad(nn.Module):
+    """ Zero-pad a CHW image tensor to a square, extra row/column goes first.
+    """
+    def forward(self, img):
+        _, h, w = img.shape
+        dh, dw = max(0, w - h), max(0, h - w)
+        return F.pad(img, [dw - dw // 2, dw // 2, dh - dh // 2, dh // 2])
 
 def get_transforms(transform_type, image_size):
     if transform_type == 'pad':
         train_transform = Compose([
+            ToImage(),
             ColorJitter(),
             RandomHorizontalFlip(p=0.5),
             SquarePad(),
-            Resize(image_size)
+            Resize(image_size, antialias=True)
         ])
 
         test_transform = Compose([
+            ToImage(),
             SquarePad(),
-            Resize(image_size)
+            Resize(image_size, antialias=True)
         ])
 
     elif transform_type == 'pad_tta':
         train_transform = Compose([
+            ToImage(),
             ColorJitter(),
             RandomHorizontalFlip(p=0.5),
             SquarePad(),
-            Resize(image_size)
+            Resize(image_size, antialias=True)
         ])
 
         test_transform = Compose([
+            ToImage(),
             RandomHorizontalFlip(p=0.5),
             SquarePad(),
-            Resize(image_size)
+            Resize(image_size, antialias=True)
         ])
 
     elif transform_type == 'crop':
         train_transform = Compose([
+            ToImage(),
             ColorJitter(),
             RandomHorizontalFlip(p=0.5),
-            RandomResizedCrop(image_size, scale=(0.7, 1.0))
+            RandomResizedCrop(image_size, scale=(0.7, 1.0), antialias=True)
         ])
 
         test_transform = Compose([
-            Resize(360),
+            ToImage(),
+            Resize(360, antialias=True),
             CenterCrop((image_size, image_size))
         ])
 
     elif transform_type == 'crop_tta':
         train_transform = Compose([
+            ToImage(),
             ColorJitter(),
             RandomHorizontalFlip(p=0.5),
-            RandomResizedCrop(image_size, scale=(0.7, 1.0))
+            RandomResizedCrop(image_size, scale=(0.7, 1.0), antialias=True)
         ])
 
         test_transform = Compose([
+            ToImage(),
             RandomHorizontalFlip(p=0.5),
-            RandomResizedCrop(image_size, scale=(0.7, 1.0))
+            RandomResizedCrop(image_size, scale=(0.7, 1.0), antialias=True)
         ])
 
     elif transform_type == 'resize_crop':
         train_transform = Compose([
-            Resize(image_size),
+            ToImage(),
+            Resize(image_size, antialias=True),
             RandomCrop(image_size),
             RandomHorizontalFlip(),
         ])
 
         test_transform = Compose([
-            Resize(image_size),
+            ToImage(),
+            Resize(image_size, antialias=True),
             RandomCrop(image_size),
             RandomHorizontalFlip(),
         ])
 
     elif transform_type == 'variable_size':
-        train_transform = RandomHorizontalFlip()
-        test_transform = RandomHorizontalFlip()
+        train_transform = Compose([ToImage(), RandomHorizontalFlip()])
+        test_transform = Compose([ToImage(), RandomHorizontalFlip()])
 
     else:
         train_transform = Compose([
+            ToImage(),
             RandomCrop(image_size),
             RandomHorizontalFlip(),
         ])
 
         test_transform = Compose([
+            ToImage(),
             RandomCrop(image_size),
             RandomHorizontalFlip(),
         ])
 
     return train_transform, test_transform
 
+
+class BatchNormalize(object):
+    """ Scale a uint8 NCHW batch to [0, 1] and normalize it,
+    on the device where mean and std live.
+    """
+    def __init__(self, mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225),
+                 device='cpu'):
+        self.mean = torch.tensor(mean, device=device)[None, :, None, None]
+        self.std = torch.tensor(std, device=device)[None, :, None, None]
+
+    def __call__(self, inputs):
+        return inputs.float().div_(255).sub_(self.mean).div_(self.std)
+
+
+# normalization is done on the batch by BatchNormalize, so that workers
+# and host-to-device copies deal with 4x smaller uint8 tensors
 tensor_transform = Compose([
-    ToTensor(),
-    Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
+    ToImage(),
+    ToDtype(torch.uint8, scale=False),
 ])
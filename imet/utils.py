@@ -4,8 +4,10 @@ import glob
 import os
 from pathlib import Path
 from multiprocessing.pool import ThreadPool
-from typing import Dict
+import threading
+from typing import Dict, Sequence
 
+import h5py
 import numpy as np
 import pandas as pd
 from scipy.stats.mstats import gmean
@@ -42,6 +44,29 @@ def mean_df(df: pd.DataFrame) -> pd.DataFrame:
     return df.groupby(level=0).mean()
 
 
+def save_predictions(path: Path, ids: Sequence[str], probabilities: np.ndarray):
+    """ Save per-id probabilities as an lzf-compressed, chunked fp16 dataset.
+    """
+    with h5py.File(str(path), 'w') as f:
+        f.create_dataset(
+            'id', data=np.array(ids, dtype=object), dtype=h5py.string_dtype())
+        f.create_dataset(
+            'prob', data=probabilities, dtype='float16',
+            chunks=(max(1, min(4096, len(ids))), probabilities.shape[1]),
+            compression='lzf')
+
+
+def load_predictions(path: Path) -> pd.DataFrame:
+    """ Load predictions saved by save_predictions, indexed by id.
+    """
+    with h5py.File(str(path), 'r') as f:
+        probabilities = f['prob'][:].astype(np.float32)
+        ids = pd.Index(f['id'].asstr()[:], name='id')
+    return pd.DataFrame(
+        data=probabilities, index=ids,
+        columns=map(str, range(probabilities.shape[1])))
+
+
 def load_model(model: nn.Module, path: Path) -> Dict:
     state = torch.load(str(path))
     model.load_state_dict(state['model'])
@@ -50,28 +75,97 @@ def load_model(model: nn.Module, path: Path) -> Dict:
 
 
 class ThreadingDataLoader(DataLoader):
+    """ DataLoader which loads items in a thread pool.
+
+    ``prefetch_factor`` is the number of batches loaded ahead of the one
+    being consumed, and with ``persistent_workers`` the pool is reused
+    across epochs instead of being re-created on each iteration,
+    call ``close()`` to shut it down.
+    """
+    def __init__(self, *args, prefetch_factor: int = 1,
+                 persistent_workers: bool = False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._prefetch = prefetch_factor
+        self._persistent_pool = persistent_workers
+        self._pool = None
+
     def __iter__(self):
         sample_iter = iter(self.batch_sampler)
         if self.num_workers == 0:
             for indices in sample_iter:
-                yield self.collate_fn([self._get_item(i) for i in indices])
+                yield self._collate([self._get_item(i) for i in indices])
         else:
-            prefetch = 1
-            with ThreadPool(processes=self.num_workers) as pool:
-                futures = []
+            pool = self._get_pool()
+            cancelled = threading.Event()
+            futures = []
+            try:
                 for indices in sample_iter:
-                    futures.append([pool.apply_async(self._get_item, args=(i,))
-                                    for i in indices])
-                    if len(futures) > prefetch:
-                        yield self.collate_fn([f.get() for f in futures.pop(0)])
-                    # items = pool.map(lambda i: self.dataset[i], indices)
-                    # yield self.collate_fn(items)
-                for batch_futures in futures:
-                    yield self.collate_fn([f.get() for f in batch_futures])
+                    futures.append(
+                        self._submit_batch(pool, indices, cancelled))
+                    if len(futures) > self._prefetch:
+                        yield futures.pop(0).get()
+                while futures:
+                    yield futures.pop(0).get()
+            finally:
+                # iteration stopped early: skip the queued batches and
+                # wait for them, so they don't delay the next iteration
+                cancelled.set()
+                for batch_future in futures:
+                    batch_future.wait()
+                if not self._persistent_pool:
+                    self.close()
+
+    def close(self):
+        if getattr(self, '_pool', None) is not None:
+            self._pool.terminate()
+            self._pool = None
+
+    def __del__(self):
+        self.close()
+
+    def _get_pool(self) -> ThreadPool:
+        if self._pool is None:
+            self._pool = ThreadPool(processes=self.num_workers)
+        return self._pool
+
+    def _submit_batch(self, pool: ThreadPool, indices,
+                      cancelled: threading.Event):
+        """ Load items in parallel, then collate and pin them in the pool
+        too, so that the consumer only gets ready (pinned) batches.
+        Collation is queued after its items, so it can't block on them.
+        """
+        item_futures = [
+            pool.apply_async(self._get_item_unless, args=(i, cancelled))
+            for i in indices]
+
+        def collate():
+            items = [f.get() for f in item_futures]
+            if not cancelled.is_set():
+                return self._collate(items)
+
+        return pool.apply_async(collate)
 
     def _get_item(self, i):
         return self.dataset[i]
 
+    def _get_item_unless(self, i, cancelled: threading.Event):
+        if not cancelled.is_set():
+            return self._get_item(i)
+
+    def _collate(self, items):
+        batch = self.collate_fn(items)
+        if self.pin_memory:
+            batch = _pin_memory(batch)
+        return batch
+
+
+def _pin_memory(batch):
+    if isinstance(batch, torch.Tensor):
+        return batch.pin_memory()
+    elif isinstance(batch, (list, tuple)):
+        return type(batch)(_pin_memory(x) for x in batch)
+    return batch
+
 
 def write_event(log, epoch: int, step: int, lr: float, **data):
     data['epoch'] = epoch